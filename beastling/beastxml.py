@@ -10,39 +10,71 @@ import beastling.beast_maps as beast_maps
 from beastling.util import xml
 
 
+_INDENTS = ["\n" + level*"  " for level in range(32)]
+
+
+def _indentation(level):
+    return _INDENTS[level] if level < len(_INDENTS) else "\n" + level*"  "
+
+
 def indent(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
+    if hasattr(xml.ET, 'indent'):
+        # ElementTree.indent is available from Python 3.9 (and in lxml), so we use it if we can.
+        xml.ET.indent(elem, space="  ", level=level)
         if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
+            elem.tail = "\n" + level*"  "
+        return
+    # We walk the tree with an explicit stack rather than recursively. The last child of an element
+    # is indented to the level of its parent, so that the closing tag of the parent lines up.
+    stack = [(elem, level, False)]
+    while stack:
+        elem, level, last = stack.pop()
+        i = _indentation(level)
+        tail = _indentation(level - 1) if last else i
+        if len(elem):
+            if not elem.text or not elem.text.strip():
+                elem.text = i + "  "
+            if not elem.tail or not elem.tail.strip():
+                elem.tail = tail
+            children = list(elem)
+            stack.extend((child, level + 1, False) for child in children[:-1])
+            stack.append((children[-1], level + 1, True))
+        elif level and (not elem.tail or not elem.tail.strip()):
+            elem.tail = tail
+
+
+def _resolve(value, parent):
+    """
+    Yield the IDs an id or idref attribute value stands for.
+    """
+    if parent is not None and parent.tag == 'plate':
+        # Quick and dirty plate handling.
+        # We only support plate matching in direct children of the plate.
+        parts = value.split('$({0})'.format(parent.get('var')))
+        for id_ in parent.get('range').split(','):
+            yield id_.join(parts)
     else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+        yield value
 
 
 def collect_ids_and_refs(root):
     data = dict(id=collections.Counter(), idref=collections.Counter())
-    parent_map = {c: p for p in root.iter() for c in p}
-    for e in root.iter():
+    id_counter, idref_counter = data['id'], data['idref']
+
+    def _walk(e, parent):
         for attrib, value in e.items():
-            for attr, collection in data.items():
-                if attrib == attr:
-                    if e in parent_map and parent_map[e].tag == 'plate':
-                        # Quick and dirty plate handling.
-                        # We only support plate matching in direct children of the plate.
-                        var = parent_map[e].get('var')
-                        for id_ in parent_map[e].get('range').split(','):
-                            collection.update([value.replace('$({0})'.format(var), id_)])
-                    else:
-                        collection.update([value])
-            if (attrib not in data) and value.startswith("@"):
-                data['idref'].update([value[1:]])
+            if attrib == 'id':
+                for id_ in _resolve(value, parent):
+                    id_counter[id_] += 1
+            elif attrib == 'idref':
+                for id_ in _resolve(value, parent):
+                    idref_counter[id_] += 1
+            elif value.startswith("@"):
+                idref_counter[value[1:]] += 1
+        for child in e:
+            _walk(child, e)
+
+    _walk(root, None)
     return data
 
 
@@ -62,6 +94,8 @@ class BeastXml(object):
         for clock in self.config.clocks:
             clock.beastxml = self
         self._taxon_sets = {}
+        self._taxon_set_by_taxa = {}
+        self._data_file_texts = {}
         self.build_xml()
         self.validate_ids()
 
@@ -70,6 +104,9 @@ class BeastXml(object):
         Creates a complete BEAST XML configuration file as an ElementTree,
         descending from the self.beast element.
         """
+        # Calibrations are iterated in the same order when adding priors and loggers.
+        self._sorted_calibrations = sorted(itertools.chain(
+            self.config.calibrations.items(), self.config.tip_calibrations.items()))
         self.beast = xml.beast(
             version="2.0",
             beautitemplate="Standard",
@@ -135,10 +172,14 @@ class BeastXml(object):
         """
         Return an ElementTree node corresponding to a comment containing
         the text of the specified data file.
+
+        Each data file is only read once, even if it is embedded several times.
         """
+        if filename not in self._data_file_texts:
+            self._data_file_texts[filename] = Path(filename).read_text(encoding='utf8')
         return xml.comment("\n".join([
             "BEASTling embedded data file: %s" % filename,
-            Path(filename).read_text(encoding='utf8')]))
+            self._data_file_texts[filename]]))
 
     def add_maps(self):
         """
@@ -262,17 +303,18 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
             xml.distribution(
                 self.prior,
                 id="constraints",
-                spec= "beast.math.distributions.MultiMonophyleticConstraint",
-                tree= "@{:}".format(self.config.treeprior.tree_id),
-                newick= self.config.languages.monophyly_newick,
+                spec="beast.math.distributions.MultiMonophyleticConstraint",
+                tree="@%s" % self.config.treeprior.tree_id,
+                newick=self.config.languages.monophyly_newick,
             )
 
     def add_calibrations(self):
         """
         Add timing calibrations to prior distribution.
         """
-        # This itertools.cchain is a bit ugly, I wonder if we can get away with sticking them all in one list...
-        for clade, cal in sorted(itertools.chain(self.config.calibrations.items(), self.config.tip_calibrations.items())):
+        tree_ref = "@%s" % self.config.treeprior.tree_id
+        prior = self.prior
+        for clade, cal in self._sorted_calibrations:
             # Don't add an MRCA cal for point calibrations, those only exist to
             # cause the initial tip height to be set
             if cal.dist == "point":
@@ -280,17 +322,18 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
             # BEAST's logcombiner chokes on spaces...
             clade = clade.replace(" ","_")
             # Create MRCAPrior node
-            attribs = {}
-            attribs["id"] = clade + "MRCA"
-            attribs["monophyletic"] = "true"
-            attribs["spec"] = "beast.math.distributions.MRCAPrior"
-            attribs["tree"] = "@{:}".format(self.config.treeprior.tree_id)
+            attribs = {
+                "id": clade + "MRCA",
+                "monophyletic": "true",
+                "spec": "beast.math.distributions.MRCAPrior",
+                "tree": tree_ref,
+            }
             if cal.originate:
                 attribs["useOriginate"] = "true"
             elif len(cal.langs) == 1:   # If there's only 1 lang and it's not an originate cal, it must be a tip cal
                 attribs["tipsonly"] = "true"
 
-            cal_prior = xml.distribution(self.prior, attrib=attribs)
+            cal_prior = xml.distribution(prior, attrib=attribs)
 
             # Create "taxonset" param for MRCAPrior
             self.add_taxon_set(
@@ -311,32 +354,42 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
         definition of the tree).  If this is not the case, passing
         define_taxa=True will define, rather than refer to, the taxa.
         """
-        # Kill duplicates
-        langs = sorted(list(set(langs)))
+        key = frozenset(langs)
 
         # If we've been asked to build an emtpy TaxonSet, something is very wrong,
         # so better to die loud and early
-        assert langs
+        assert key
         # Refer to any previous TaxonSet with the same languages
-        for idref, taxa in self._taxon_sets.items():
-            if langs == taxa:
-                xml.taxonset(parent, idref=idref)
-                return
-        if len(langs) == 1 and label == langs[0]:
-            # Single taxa are IDs already. They cannot also be taxon set ids.
-            label = "tx_{:}".format(label)
+        if key in self._taxon_set_by_taxa:
+            xml.taxonset(parent, idref=self._taxon_set_by_taxa[key])
+            return
         # Otherwise, create and register a new TaxonSet
+        taxon_attr = "id" if define_taxa else "idref"
+        if len(key) == 1:
+            # Single languages (e.g. tip calibrations) need neither sorting nor plates.
+            lang, = key
+            if label == lang:
+                # Single taxa are IDs already. They cannot also be taxon set ids.
+                label = "tx_{:}".format(label)
+            xml.taxon(xml.taxonset(parent, id=label, spec="TaxonSet"), attrib={taxon_attr: lang})
+            self._taxon_sets[label] = [lang]
+            self._taxon_set_by_taxa[key] = label
+            return
+        # Kill duplicates
+        langs = sorted(key)
         taxonset = xml.taxonset(parent, id=label, spec="TaxonSet")
         ## If the taxonset is more than 3 languages in size, use plate notation to minimise XML filesize
         if len(langs) > 3:
             xml.taxon(
                 xml.plate(taxonset, var="language", range=langs),
-                attrib={"id" if define_taxa else "idref" :"$(language)"})
+                attrib={taxon_attr: "$(language)"})
         ## Otherwise go for the more readable notation...
         else:
+            taxon = xml.taxon
             for lang in langs:
-                xml.taxon(taxonset, attrib={"id" if define_taxa else "idref" : lang})
+                taxon(taxonset, attrib={taxon_attr: lang})
         self._taxon_sets[label] = langs
+        self._taxon_set_by_taxa[key] = label
 
     def add_likelihood(self):
         """
@@ -368,18 +421,20 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
                 id="featureClockRateDeltaExchanger:%s" % clock.name,
                 spec="DeltaExchangeOperator",
                 weight="3.0")
+            all_weights = []
             for model in clock_models:
                 xml.parameter(
                     xml.plate(delta, var="rate", range=model.all_rates),
                     idref="featureClockRate:%s:$(rate)" % model.name)
+                all_weights.extend(model.weights)
             # Add weight vector if there has been any binarisation
-            if any([w != 1 for w in itertools.chain(*[m.weights for m in clock_models])]):
+            if any(w != 1 for w in all_weights):
                 xml.weightvector(
                     delta,
-                    text=" ".join(itertools.chain(*[map(str, m.weights) for m in clock_models])),
+                    text=" ".join(map(str, all_weights)),
                     id="featureClockRateWeightParameter:%s" % clock.name,
                     spec="parameter.IntegerParameter",
-                    dimension=str(sum([len(m.weights) for m in clock_models])),
+                    dimension=str(len(all_weights)),
                     estimate="false")
 
 
@@ -395,7 +450,7 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
         self.add_tree_loggers()
 
         # Log individual reconstructed traits (and possibly other per-generation metadata)
-        if any([model.metadata for model in self.config.models]):
+        if any(model.metadata for model in self.config.models):
             self.add_trait_logger("_reconstructed")
 
     def add_screen_logger(self):
@@ -435,7 +490,7 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
                 model.add_param_logs(tracer_logger)
 
         # Log calibration clade heights
-        for clade, cal in sorted(itertools.chain(self.config.calibrations.items(), self.config.tip_calibrations.items())):
+        for clade, cal in self._sorted_calibrations:
             # Don't log unchanging tip heights
             if cal.dist == "point":
                 continue
@@ -449,15 +504,16 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
             return
 
         pure_tree_done = False
-        non_strict_clocks = set([m.clock for m in self.config.models if not m.clock.is_strict])
+        non_strict_clocks = {m.clock for m in self.config.models if not m.clock.is_strict}
         if not non_strict_clocks:
             # All clocks are strict, so we just do one pure log file
             self.add_tree_logger()
             pure_tree_done = True
         else:
             # There are non-strict clocks, so we do one log file each with branch rates
+            single_clock = len(non_strict_clocks) == 1
             for clock in non_strict_clocks:
-                if len(non_strict_clocks) == 1:
+                if single_clock:
                     self.add_tree_logger("", clock.branchrate_model_id)
                 else:
                     self.add_tree_logger("_%s_rates" % clock.name, clock.branchrate_model_id)
@@ -467,7 +523,7 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
             self.add_tree_logger("_pure")
 
         # Log reconstructed traits (and possibly other per-node metadata)
-        if any([model.treedata for model in self.config.models]):
+        if any(model.treedata for model in self.config.models):
             self.add_trait_tree_logger("_reconstructed")
 
         # Created a dedicated geographic tree log if asked to log locations,
@@ -488,7 +544,7 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
             tree_logger,
             id="TreeLoggerWithMetaData" + suffix,
             spec="beast.evolution.tree.TreeWithMetaDataLogger",
-            tree="@{:}".format(self.config.treeprior.tree_id),
+            tree="@%s" % self.config.treeprior.tree_id,
             dp=self.config.admin.log_dp)
         if branchrate_model_id:
             xml.branchratemodel(log, idref=branchrate_model_id)
@@ -511,7 +567,7 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
             tree_logger,
             id="ReconstructedStateTreeLogger",
             spec="beast.evolution.tree.TreeWithTraitLogger",
-            tree="@{:}".format(self.config.treeprior.tree_id))
+            tree="@%s" % self.config.treeprior.tree_id)
         for model in self.config.models:
             for md in model.treedata:
                 xml.metadata(log, idref=md)
@@ -529,11 +585,11 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
 
     def validate_ids(self):
         data = collect_ids_and_refs(self.beast)
-        duplicate_ids = {id_ for id_, count in data['id'].most_common() if count > 1}
+        duplicate_ids = {id_ for id_, count in data['id'].items() if count > 1}
         if duplicate_ids:
             raise ValueError("Duplicate BEASTObject IDs found: " + ", ".join(sorted(duplicate_ids)))
 
-        bad_refs = set(data['idref']) - set(data['id'])
+        bad_refs = data['idref'].keys() - data['id'].keys()
         if bad_refs:
             raise ValueError("References to missing BEASTObject IDs found: " + ", ".join(bad_refs))
 
@@ -547,9 +603,18 @@ java -cp $(java.class.path) beast.app.beastapp.BeastMain $(resume/overwrite) -ja
         return out.read()
 
     def write(self, stream):
-        indent(self.beast)
-        tree = xml.ElementTree(self.beast)
-        tree.write(stream, encoding='UTF-8', xml_declaration=True)
+        """
+        Serialize the XML document to a binary stream.
+
+        The serializer writes to the stream as it walks the tree, so the
+        document is never held in memory as a whole in serialized form.
+        """
+        if xml.LXML:
+            xml.ElementTree(self.beast).write(
+                stream, encoding='UTF-8', xml_declaration=True, pretty_print=True)
+        else:
+            indent(self.beast)
+            xml.ElementTree(self.beast).write(stream, encoding='UTF-8', xml_declaration=True)
 
     def write_file(self, filename=None):
         """
@@ -359,7 +359,7 @@ class Configuration(object):
             log.warning("value of 'families' has length 1: have you misspelled a filename?")
 
         # Enforce minimum data constraint
-        all_langs = set(itertools.chain(*[model.data.keys() for model in self.models]))
+        all_langs = set(itertools.chain.from_iterable(model.data for model in self.models))
         N = sum([max([len(lang.keys()) for lang in model.data.values()]) for model in self.models])
         datapoint_props = {}
         for lang in all_langs:
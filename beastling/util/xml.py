@@ -1,6 +1,13 @@
 import re
 import functools
-from xml.etree import ElementTree as ET
+
+try:  # pragma: no cover
+    # lxml serializes (and pretty-prints) in C, which is a lot faster for big BEAST XML files.
+    from lxml import etree as ET
+    LXML = True
+except ImportError:  # pragma: no cover
+    from xml.etree import ElementTree as ET
+    LXML = False
 
 ElementTree = ET.ElementTree
 
@@ -3,7 +3,7 @@ from xml.etree import ElementTree
 import pytest
 
 from beastling.util import xml
-from beastling.beastxml import collect_ids_and_refs, BeastXml
+from beastling.beastxml import collect_ids_and_refs, indent, BeastXml
 
 
 @pytest.mark.parametrize(
@@ -25,6 +25,21 @@ def test_collect_ids_and_refs(xml, assertion):
     assert assertion(res)
 
 
+@pytest.mark.parametrize('native', [True, False])
+def test_indent(native, monkeypatch):
+    if not native:
+        monkeypatch.delattr(xml.ET, 'indent', raising=False)
+    e = xml.ET.fromstring('<a><b><c/><c/></b><b/></a>')
+    indent(e)
+    assert [(ee.text, ee.tail) for ee in e.iter()] == [
+        ('\n  ', '\n'),
+        ('\n    ', '\n  '),
+        (None, '\n    '),
+        (None, '\n  '),
+        (None, '\n'),
+    ]
+
+
 def test_path_sampling(config_factory):
     config = config_factory('basic')
     config.mcmc.path_sampling = True
@@ -45,3 +60,16 @@ def test_validate_ids(config_factory):
     xml.data(bml.beast, idref='theid')
     with pytest.raises(ValueError, match='missing'):
         bml.validate_ids()
+
+
+def test_add_taxon_set(config_factory):
+    bml = BeastXml(config_factory('basic'))
+    parent = xml.data(None)
+    bml.add_taxon_set(parent, 'clade', ['aal', 'aas', 'aal'])
+    bml.add_taxon_set(parent, 'other', ['aas', 'aal'])
+    first, second = parent
+    assert first.get('id') == 'clade' and len(first) == 2
+    assert second.get('idref') == 'clade'
+
+    bml.add_taxon_set(parent, 'aal', ('aal',))
+    assert parent[-1].get('id') == 'tx_aal' and len(parent[-1]) == 1